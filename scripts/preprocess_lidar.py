@@ -1,53 +1,192 @@
 #!/usr/bin/env python3
 import argparse
+import functools
+import hashlib
 import json
 import math
 import os
+import queue
+import threading
 from pathlib import Path
-from multiprocessing import Pool, cpu_count
+from multiprocessing import Lock, Pool, cpu_count
+from multiprocessing.shared_memory import SharedMemory
 
 import laspy
 import numpy as np
-from pyproj import Transformer
+from pyproj import CRS, Transformer
 
+try:
+    import numba
+except ImportError:  # optional: fall back to the numpy histogram path
+    numba = None
 
-def iter_chunks(lidar_path, chunk_size):
+GRID_NAMES = ("dsm_sum", "dsm_cnt", "dtm_sum", "dtm_cnt")
+
+# Per-process transformer, set by _init_worker in each Pool worker; None when
+# the source CRS already is the EPSG:3857 grid CRS.
+_TRANSFORMER = None
+# Shared (dsm_sum, dsm_cnt, dtm_sum, dtm_cnt) grids, set by _init_grid_worker.
+_SHARED_SHM = None
+_SHARED_GRIDS = None
+_SHARED_LOCK = None
+
+
+@functools.lru_cache(maxsize=None)
+def _get_transformer(src, dst):
+    return Transformer.from_crs(src, dst, always_xy=True)
+
+
+def _init_worker(source_crs, workers):
+    global _TRANSFORMER
+    if CRS.from_user_input(source_crs) == CRS.from_user_input("EPSG:3857"):
+        _TRANSFORMER = None
+    else:
+        _TRANSFORMER = _get_transformer(source_crs, "EPSG:3857")
+    if numba is not None:
+        # Split the cores between pool processes instead of oversubscribing.
+        numba.set_num_threads(max(1, min(numba.config.NUMBA_NUM_THREADS, cpu_count() // workers)))
+
+
+def _init_grid_worker(source_crs, workers, shm_name, resolution, lock):
+    global _SHARED_SHM, _SHARED_GRIDS, _SHARED_LOCK
+    _init_worker(source_crs, workers)
+    _SHARED_SHM = SharedMemory(name=shm_name)
+    _SHARED_GRIDS = np.ndarray((4, resolution, resolution), dtype=np.float64, buffer=_SHARED_SHM.buf)
+    _SHARED_LOCK = lock
+
+
+def split_tasks(lidar_paths, task_size):
+    """(path, start, stop) point spans of at most task_size points each."""
+    tasks = []
+    for path in lidar_paths:
+        with laspy.open(path) as las:
+            point_count = las.header.point_count
+        for start in range(0, point_count, task_size):
+            tasks.append((path, start, min(start + task_size, point_count)))
+    return tasks
+
+
+def iter_chunks(lidar_path, chunk_size, start=0, stop=None):
     with laspy.open(lidar_path) as las:
-        for points in las.chunk_iterator(chunk_size):
+        if stop is None:
+            stop = las.header.point_count
+        if start:
+            las.seek(start)
+        remaining = stop - start
+        while remaining > 0:
+            points = las.read_points(min(chunk_size, remaining))
+            if len(points) == 0:
+                break
+            remaining -= len(points)
             yield points
 
 
-def _bounds_for_file(args):
-    path, chunk_size, source_crs = args
-    transformer = Transformer.from_crs(source_crs, "EPSG:3857", always_xy=True)
+_END = object()
+
+
+def prefetch_chunks(lidar_path, chunk_size, start=0, stop=None, depth=2):
+    """Like iter_chunks, but decompresses ahead on a background thread.
+
+    LAZ decoding and the numpy/pyproj work on the consumer side both release
+    the GIL, so reading the next chunk overlaps with processing this one.
+    """
+    q = queue.Queue(maxsize=depth)
+    done = threading.Event()
+
+    def put(item):
+        while not done.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for points in iter_chunks(lidar_path, chunk_size, start, stop):
+                if not put(points):
+                    return
+        except BaseException as exc:
+            put(exc)
+        else:
+            put(_END)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = q.get()
+            if item is _END:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        done.set()
+        thread.join()
+
+
+if numba is not None:
+
+    @numba.njit(nogil=True, cache=True)
+    def minmax_xy(x, y):
+        """(min x, max x, min y, max y) in a single sweep over the points."""
+        mnx = np.inf
+        mxx = -np.inf
+        mny = np.inf
+        mxy = -np.inf
+        for i in range(x.shape[0]):
+            xi = x[i]
+            yi = y[i]
+            if xi < mnx:
+                mnx = xi
+            if xi > mxx:
+                mxx = xi
+            if yi < mny:
+                mny = yi
+            if yi > mxy:
+                mxy = yi
+        return mnx, mxx, mny, mxy
+
+else:
+
+    def minmax_xy(x, y):
+        return np.min(x), np.max(x), np.min(y), np.max(y)
+
+
+def _bounds_for_span(args):
+    path, start, stop, chunk_size = args
+    transformer = _TRANSFORMER
     minx = math.inf
     miny = math.inf
     maxx = -math.inf
     maxy = -math.inf
-    for points in iter_chunks(path, chunk_size):
+    for points in prefetch_chunks(path, chunk_size, start, stop):
         x = np.asarray(points.x)
         y = np.asarray(points.y)
-        x_merc, y_merc = transformer.transform(x, y)
-        minx = min(minx, float(np.min(x_merc)))
-        miny = min(miny, float(np.min(y_merc)))
-        maxx = max(maxx, float(np.max(x_merc)))
-        maxy = max(maxy, float(np.max(y_merc)))
+        x_merc, y_merc = (x, y) if transformer is None else transformer.transform(x, y)
+        bx, Bx, by, By = minmax_xy(x_merc, y_merc)
+        minx = min(minx, float(bx))
+        miny = min(miny, float(by))
+        maxx = max(maxx, float(Bx))
+        maxy = max(maxy, float(By))
     return (minx, miny, maxx, maxy)
 
 
-def compute_bounds_parallel(lidar_paths, chunk_size, source_crs, workers):
+def compute_bounds_parallel(lidar_paths, chunk_size, task_size, source_crs, workers):
     minx = math.inf
     miny = math.inf
     maxx = -math.inf
     maxy = -math.inf
-    tasks = [(p, chunk_size, source_crs) for p in lidar_paths]
+    tasks = [span + (chunk_size,) for span in split_tasks(lidar_paths, task_size)]
 
-    with Pool(processes=workers) as pool:
+    with Pool(processes=workers, initializer=_init_worker, initargs=(source_crs, workers)) as pool:
         total = len(tasks)
         done = 0
-        for bx, by, Bx, By in pool.imap_unordered(_bounds_for_file, tasks):
+        for bx, by, Bx, By in pool.imap_unordered(_bounds_for_span, tasks):
             done += 1
-            print(f"[bounds] {done}/{total} files processed")
+            print(f"[bounds] {done}/{total} tasks processed")
             minx = min(minx, bx)
             miny = min(miny, by)
             maxx = max(maxx, Bx)
@@ -59,62 +198,192 @@ def compute_bounds_parallel(lidar_paths, chunk_size, source_crs, workers):
     return minx, miny, maxx, maxy
 
 
-def add_histogram(acc_sum, acc_cnt, x, y, z, x_edges, y_edges):
-    h_sum, _, _ = np.histogram2d(x, y, bins=[x_edges, y_edges], weights=z)
-    h_cnt, _, _ = np.histogram2d(x, y, bins=[x_edges, y_edges])
-    acc_sum += h_sum
-    acc_cnt += h_cnt
+def compute_header_bounds(lidar_paths, source_crs):
+    """Dataset bounds from the LAS header extents, without reading any points."""
+    transformer = _get_transformer(source_crs, "EPSG:3857")
+    minx = math.inf
+    miny = math.inf
+    maxx = -math.inf
+    maxy = -math.inf
+    total = len(lidar_paths)
+    for done, path in enumerate(lidar_paths, start=1):
+        with laspy.open(path) as las:
+            point_count = las.header.point_count
+            mins = las.header.mins
+            maxs = las.header.maxs
+        if point_count == 0:
+            # Empty files have zeroed extents that would stretch the grid to the origin
+            print(f"[bounds] {done}/{total} skipping {path} (no points)")
+            continue
+        # Densified edges, since straight native edges curve in EPSG:3857
+        bx, by, Bx, By = transformer.transform_bounds(mins[0], mins[1], maxs[0], maxs[1])
+        print(f"[bounds] {done}/{total} file headers read")
+        minx = min(minx, bx)
+        miny = min(miny, by)
+        maxx = max(maxx, Bx)
+        maxy = max(maxy, By)
 
+    if not np.isfinite([minx, miny, maxx, maxy]).all():
+        raise RuntimeError("No valid bounds found in input file headers.")
 
-def _grids_for_file(args):
-    path, resolution, chunk_size, source_crs, x_edges, y_edges = args
-    transformer = Transformer.from_crs(source_crs, "EPSG:3857", always_xy=True)
-    dsm_sum = np.zeros((resolution, resolution), dtype=np.float64)
-    dsm_cnt = np.zeros((resolution, resolution), dtype=np.float64)
-    dtm_sum = np.zeros((resolution, resolution), dtype=np.float64)
-    dtm_cnt = np.zeros((resolution, resolution), dtype=np.float64)
+    return minx, miny, maxx, maxy
 
-    for points in iter_chunks(path, chunk_size):
-        x = np.asarray(points.x)
-        y = np.asarray(points.y)
-        z = np.asarray(points.z)
-        cls = np.asarray(points.classification)
 
-        x_merc, y_merc = transformer.transform(x, y)
-        add_histogram(dsm_sum, dsm_cnt, x_merc, y_merc, z, x_edges, y_edges)
+def bin_indices(x, y, minx, miny, inv_dx, inv_dy, resolution):
+    """Flat (ix * resolution + iy) grid cell index of each point."""
+    # Bins are uniform, so lookup is an affine map rather than a searchsorted.
+    ix = ((x - minx) * inv_dx).astype(np.intp)
+    iy = ((y - miny) * inv_dy).astype(np.intp)
+    np.clip(ix, 0, resolution - 1, out=ix)
+    np.clip(iy, 0, resolution - 1, out=iy)
+    ix *= resolution
+    ix += iy
+    return ix
+
+
+def add_histogram(acc_sum, acc_cnt, flat, z):
+    size = acc_sum.size
+    acc_sum += np.bincount(flat, weights=z, minlength=size).reshape(acc_sum.shape)
+    acc_cnt += np.bincount(flat, minlength=size).reshape(acc_cnt.shape)
+
+
+if numba is not None:
+
+    @numba.njit(parallel=True, fastmath=True, nogil=True, cache=True)
+    def accumulate(x, y, z, cls, minx, miny, inv_dx, inv_dy, local):
+        """Single pass DSM+DTM sum/count accumulation into per-thread grids local[t]."""
+        n = x.shape[0]
+        nt = local.shape[0]
+        R = local.shape[2]
+        per = (n + nt - 1) // nt
+        for t in numba.prange(nt):
+            g = local[t]
+            for i in range(t * per, min(n, (t + 1) * per)):
+                ix = min(max(int((x[i] - minx) * inv_dx), 0), R - 1)
+                iy = min(max(int((y[i] - miny) * inv_dy), 0), R - 1)
+                g[0, ix, iy] += z[i]
+                g[1, ix, iy] += 1.0
+                if cls[i] == 2:
+                    g[2, ix, iy] += z[i]
+                    g[3, ix, iy] += 1.0
+
+
+def relative_coords(raw, scale, offset, origin):
+    """float32 (raw * scale + offset - origin) straight from raw LAS integers."""
+    # Subtract the origin in integer raw units first so the float32 values stay small.
+    raw0 = int(math.floor((origin - offset) / scale))
+    rel = np.subtract(raw, raw0, dtype=np.int32).astype(np.float32)
+    np.multiply(rel, np.float32(scale), out=rel)
+    np.add(rel, np.float32(raw0 * scale + offset - origin), out=rel)
+    return rel
+
+
+def span_cache_path(cache_dir, path, start, stop, resolution, bounds, source_crs):
+    """Cache file for one span's partial grids; changes with the file or the grid."""
+    stat = os.stat(path)
+    minx, miny, maxx, maxy = bounds
+    key = (
+        f"{Path(path).resolve()}|{stat.st_mtime_ns}|{stat.st_size}|{start}|{stop}|"
+        f"{resolution}|{minx!r}|{miny!r}|{maxx!r}|{maxy!r}|{source_crs}"
+    )
+    return Path(cache_dir) / f"{hashlib.sha1(key.encode()).hexdigest()}.npz"
 
-        ground_mask = cls == 2
-        if np.any(ground_mask):
-            add_histogram(
-                dtm_sum,
-                dtm_cnt,
-                x_merc[ground_mask],
-                y_merc[ground_mask],
-                z[ground_mask],
-                x_edges,
-                y_edges,
-            )
 
-    return dsm_sum, dsm_cnt, dtm_sum, dtm_cnt
+def _grids_for_span(args):
+    path, start, stop, resolution, chunk_size, minx, miny, inv_dx, inv_dy, cache_path = args
+    if cache_path is not None and cache_path.exists():
+        with np.load(cache_path) as cached:
+            return tuple(cached[name] for name in GRID_NAMES)
 
+    transformer = _TRANSFORMER
+    if numba is not None:
+        # Per-thread grids live for the whole span and are reduced once at the end
+        local = np.zeros((numba.get_num_threads(), 4, resolution, resolution), dtype=np.float32)
+        dsm_sum, dsm_cnt, dtm_sum, dtm_cnt = local[0]
+    else:
+        dsm_sum, dsm_cnt, dtm_sum, dtm_cnt = np.zeros((4, resolution, resolution), dtype=np.float32)
 
-def compute_grids_parallel(lidar_paths, resolution, chunk_size, source_crs, x_edges, y_edges, workers):
-    dsm_sum = np.zeros((resolution, resolution), dtype=np.float64)
-    dsm_cnt = np.zeros((resolution, resolution), dtype=np.float64)
-    dtm_sum = np.zeros((resolution, resolution), dtype=np.float64)
-    dtm_cnt = np.zeros((resolution, resolution), dtype=np.float64)
+    for points in prefetch_chunks(path, chunk_size, start, stop):
+        z = np.asarray(points.z, dtype=np.float32)
+        cls = np.asarray(points.classification)
 
-    tasks = [(p, resolution, chunk_size, source_crs, x_edges, y_edges) for p in lidar_paths]
-    with Pool(processes=workers) as pool:
-        total = len(tasks)
-        done = 0
-        for ds, dc, ts, tc in pool.imap_unordered(_grids_for_file, tasks):
-            done += 1
-            print(f"[grids] {done}/{total} files processed")
-            dsm_sum += ds
-            dsm_cnt += dc
-            dtm_sum += ts
-            dtm_cnt += tc
+        if transformer is None:
+            # Already in the grid CRS: skip PROJ and the float64 detour entirely
+            x_merc = relative_coords(np.asarray(points.X), points.scales[0], points.offsets[0], minx)
+            y_merc = relative_coords(np.asarray(points.Y), points.scales[1], points.offsets[1], miny)
+        else:
+            x_merc, y_merc = transformer.transform(np.asarray(points.x), np.asarray(points.y))
+            # Relative to the grid origin float32 is precise enough and halves the bytes moved
+            x_merc = np.subtract(x_merc, minx, out=x_merc).astype(np.float32)
+            y_merc = np.subtract(y_merc, miny, out=y_merc).astype(np.float32)
+        if numba is not None:
+            accumulate(x_merc, y_merc, z, cls, 0.0, 0.0, inv_dx, inv_dy, local)
+            continue
+
+        flat = bin_indices(x_merc, y_merc, 0.0, 0.0, inv_dx, inv_dy, resolution)
+        add_histogram(dsm_sum, dsm_cnt, flat, z)
+
+        # DTM cells are a subset of the DSM ones: reuse the indices, no re-binning
+        ground = np.flatnonzero(cls == 2)
+        if ground.size:
+            add_histogram(dtm_sum, dtm_cnt, flat[ground], z[ground])
+
+    if numba is not None and len(local) > 1:
+        dsm_sum, dsm_cnt, dtm_sum, dtm_cnt = local.sum(axis=0)
+
+    grids = (dsm_sum, dsm_cnt, dtm_sum, dtm_cnt)
+    if cache_path is not None:
+        tmp_path = cache_path.with_name(f"{cache_path.name}.{os.getpid()}.tmp")
+        with open(tmp_path, "wb") as f:
+            np.savez_compressed(f, **dict(zip(GRID_NAMES, grids)))
+        os.replace(tmp_path, cache_path)
+    return grids
+
+
+def _add_span_to_shared(args):
+    grids = _grids_for_span(args)
+    with _SHARED_LOCK:
+        for shared, grid in zip(_SHARED_GRIDS, grids):
+            shared += grid
+    return args[0]
+
+
+def compute_grids_parallel(
+    lidar_paths, resolution, chunk_size, task_size, source_crs, bounds, workers, cache_dir=None
+):
+    minx, miny, maxx, maxy = bounds
+    inv_dx = resolution / (maxx - minx)
+    inv_dy = resolution / (maxy - miny)
+    # Point spans rather than whole files, so skewed file sizes still balance
+    tasks = []
+    for path, start, stop in split_tasks(lidar_paths, task_size):
+        cache_path = None
+        if cache_dir is not None:
+            cache_path = span_cache_path(cache_dir, path, start, stop, resolution, bounds, source_crs)
+        tasks.append(
+            (path, start, stop, resolution, chunk_size, minx, miny, inv_dx, inv_dy, cache_path)
+        )
+
+    # Workers add their grids straight into shared memory, so nothing but the
+    # finished task travels back through the pool.
+    shape = (4, resolution, resolution)
+    shm = SharedMemory(create=True, size=int(np.prod(shape)) * np.dtype(np.float64).itemsize)
+    shared = np.ndarray(shape, dtype=np.float64, buffer=shm.buf)
+    try:
+        shared.fill(0.0)
+        initargs = (source_crs, workers, shm.name, resolution, Lock())
+        with Pool(processes=workers, initializer=_init_grid_worker, initargs=initargs) as pool:
+            total = len(tasks)
+            done = 0
+            for _ in pool.imap_unordered(_add_span_to_shared, tasks):
+                done += 1
+                print(f"[grids] {done}/{total} tasks processed")
+
+        dsm_sum, dsm_cnt, dtm_sum, dtm_cnt = shared.copy()
+    finally:
+        del shared
+        shm.close()
+        shm.unlink()
 
     dsm = np.divide(dsm_sum, dsm_cnt, out=np.zeros_like(dsm_sum), where=dsm_cnt > 0)
     dtm = np.divide(dtm_sum, dtm_cnt, out=np.zeros_like(dtm_sum), where=dtm_cnt > 0)
@@ -124,14 +393,34 @@ def compute_grids_parallel(lidar_paths, resolution, chunk_size, source_crs, x_ed
     return chm, dtm, valid
 
 
+def quantize_u16(img, offset, scale):
+    """round((img - offset) / scale) clipped to uint16, using a single float buffer."""
+    buf = np.subtract(img, offset)
+    np.divide(buf, scale, out=buf)
+    np.rint(buf, out=buf)
+    np.clip(buf, 0, 65535, out=buf)
+    return buf.astype(np.uint16)
+
+
 def main():
     parser = argparse.ArgumentParser(description="Preprocess LAZ files into compact CHM grid.")
     parser.add_argument("--input", default="uploaded_lidar_data", help="Directory with .laz files")
     parser.add_argument("--output", default="web/data", help="Output directory")
     parser.add_argument("--resolution", type=int, default=1024, help="Grid resolution (NxN)")
     parser.add_argument("--chunk-size", type=int, default=5_000_000, help="Points per chunk")
+    parser.add_argument("--task-size", type=int, default=20_000_000, help="Points per worker task")
     parser.add_argument("--source-crs", default="EPSG:3067", help="Source CRS of LAZ files")
     parser.add_argument("--workers", type=int, default=max(1, cpu_count() - 1), help="Parallel workers")
+    parser.add_argument(
+        "--exact-bounds",
+        action="store_true",
+        help="Compute bounds from every point instead of the LAZ header extents",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=None,
+        help="Optional directory for per-span partial grids reused by identical re-runs",
+    )
 
     args = parser.parse_args()
 
@@ -145,21 +434,27 @@ def main():
 
     print(f"Using {args.workers} workers")
 
-    minx, miny, maxx, maxy = compute_bounds_parallel(
-        lidar_paths, args.chunk_size, args.source_crs, args.workers
-    )
+    cache_dir = None
+    if args.cache_dir is not None:
+        cache_dir = Path(args.cache_dir)
+        cache_dir.mkdir(parents=True, exist_ok=True)
 
-    x_edges = np.linspace(minx, maxx, args.resolution + 1)
-    y_edges = np.linspace(miny, maxy, args.resolution + 1)
+    if args.exact_bounds:
+        minx, miny, maxx, maxy = compute_bounds_parallel(
+            lidar_paths, args.chunk_size, args.task_size, args.source_crs, args.workers
+        )
+    else:
+        minx, miny, maxx, maxy = compute_header_bounds(lidar_paths, args.source_crs)
 
     chm, dtm, valid = compute_grids_parallel(
         lidar_paths,
         args.resolution,
         args.chunk_size,
+        args.task_size,
         args.source_crs,
-        x_edges,
-        y_edges,
+        (minx, miny, maxx, maxy),
         args.workers,
+        cache_dir,
     )
 
     # Convert to image order: row 0 = maxy, col 0 = minx
@@ -174,7 +469,7 @@ def main():
     else:
         chm_scale = max_chm / 65535.0
 
-    chm_q = np.clip(np.round(chm_img / chm_scale), 0, 65535).astype(np.uint16)
+    chm_q = quantize_u16(chm_img, 0.0, chm_scale)
 
     bin_path = output_dir / "chm_u16.bin"
     chm_q.tofile(bin_path)
@@ -182,7 +477,7 @@ def main():
     min_dtm = float(np.min(dtm_img))
     max_dtm = float(np.max(dtm_img))
     dtm_scale = (max_dtm - min_dtm) / 65535.0 if max_dtm > min_dtm else 1.0
-    dtm_q = np.clip(np.round((dtm_img - min_dtm) / dtm_scale), 0, 65535).astype(np.uint16)
+    dtm_q = quantize_u16(dtm_img, min_dtm, dtm_scale)
     dtm_path = output_dir / "dtm_u16.bin"
     dtm_q.tofile(dtm_path)
 
@@ -190,7 +485,7 @@ def main():
     valid_img.astype(np.uint8).tofile(mask_path)
 
     # Bounds in WGS84 for Leaflet
-    to_wgs84 = Transformer.from_crs("EPSG:3857", "EPSG:4326", always_xy=True)
+    to_wgs84 = _get_transformer("EPSG:3857", "EPSG:4326")
     lon_min, lat_min = to_wgs84.transform(minx, miny)
     lon_max, lat_max = to_wgs84.transform(maxx, maxy)
 
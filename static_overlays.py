@@ -0,0 +1,50 @@
+"""Overlay PNGs served by Streamlit at /app/static/overlays (see .streamlit/config.toml)."""
+import os
+
+import folium
+
+OVERLAY_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static", "overlays")
+OVERLAY_URL = "/app/static/overlays"
+MAX_OVERLAYS = 256
+
+
+class StaticImageOverlay(folium.raster_layers.ImageOverlay):
+    """ImageOverlay pointing at an already served image URL.
+
+    folium passes `image` through image_to_url, which opens anything that is
+    not an absolute URL as a local file and inlines it as a data URI, so the
+    overlay is built from an empty data URI and the URL is set afterwards.
+    """
+
+    def __init__(self, url, bounds, **kwargs):
+        super().__init__("data:,", bounds, **kwargs)
+        self.url = url
+
+
+def prune_overlays(overlay_dir=OVERLAY_DIR, keep=MAX_OVERLAYS):
+    """Delete all but the `keep` most recently used PNGs in overlay_dir."""
+    entries = [e for e in os.scandir(overlay_dir) if e.name.endswith(".png")]
+    entries.sort(key=lambda e: e.stat().st_mtime_ns, reverse=True)
+    for entry in entries[keep:]:
+        try:
+            os.remove(entry.path)
+        except FileNotFoundError:  # pruned by a concurrent session
+            pass
+
+
+def publish_overlay(content_hash, png_bytes, overlay_dir=OVERLAY_DIR, keep=MAX_OVERLAYS):
+    """Write the PNG to the static overlay dir if missing; returns its URL."""
+    path = os.path.join(overlay_dir, f"{content_hash}.png")
+    url = f"{OVERLAY_URL}/{content_hash}.png"
+    try:
+        os.utime(path)  # mark as recently used for prune_overlays
+        return url
+    except FileNotFoundError:
+        pass
+
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(png_bytes)
+    os.replace(tmp_path, path)
+    prune_overlays(overlay_dir, keep)
+    return url
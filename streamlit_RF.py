@@ -8,13 +8,21 @@ import streamlit as st
 from streamlit_folium import st_folium
 from PIL import Image
 from io import BytesIO
-from base64 import b64encode
+from static_overlays import OVERLAY_DIR, StaticImageOverlay, publish_overlay
+import hashlib
 import os
 import matplotlib as mpl
 
+try:
+    import numba
+except ImportError:  # optional: itu_r_p833 falls back to plain numpy
+    numba = None
+
 UPLOAD_DIR = "uploaded_lidar_data"
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 
+os.makedirs(OVERLAY_DIR, exist_ok=True)
+
 st.title("LiDAR-Based RF Attenuation Viewer")
 
 # 1. Multi-File Upload Section: (no file list displayed below)
@@ -36,43 +44,66 @@ if len(lidar_files) == 0:
     st.warning("No LAZ files have been uploaded yet.")
     st.stop()
 
+@st.cache_resource
+def get_transformer(src, dst):
+    """Build a Transformer once and reuse it across reruns."""
+    return Transformer.from_crs(src, dst, always_xy=True)
+
+def file_signature(path):
+    """(mtime, size) of a file, used to key cached results on file changes."""
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+def weighted_density(hist, x_edges, y_edges):
+    """Normalize a weighted 2D histogram like np.histogram2d(..., density=True)."""
+    cell_area = np.diff(x_edges)[:, None] * np.diff(y_edges)[None, :]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return hist / hist.sum() / cell_area
+
 @st.cache_data
-def load_and_compute_chm(lidar_path, resolution=50):
-    """Load LAZ, transform to EPSG:3857, compute CHM (DSM-DTM)."""
-    with laspy.open(lidar_path) as las:
-        points = las.read()
-
-    x = np.array(points.x)
-    y = np.array(points.y)
-    z = np.array(points.z)
-    classification = np.array(points.classification)
-
-    # Convert from EPSG:3067 -> EPSG:4326
-    transformer_to_wgs84 = Transformer.from_crs("EPSG:3067", "EPSG:4326", always_xy=True)
-    lon, lat = transformer_to_wgs84.transform(x, y)
-
-    # Then from EPSG:4326 -> EPSG:3857
-    transformer_to_mercator = Transformer.from_crs("EPSG:4326", "EPSG:3857", always_xy=True)
-    x_merc, y_merc = transformer_to_mercator.transform(lon, lat)
-
-    # Ground points => DTM
-    ground_mask = (classification == 2)
-    dtm, x_edges, y_edges = np.histogram2d(
-        x_merc[ground_mask],
-        y_merc[ground_mask],
-        bins=resolution,
-        weights=z[ground_mask],
-        density=True
-    )
+def load_and_compute_chm(lidar_path, signature, resolution=50, chunk_size=1_000_000, stride=20):
+    """
+    Stream LAZ in chunks, transform to EPSG:3857, compute CHM (DSM-DTM).
+    Only every `stride`-th point is used; at preview resolution the result is
+    visually identical and the density normalization cancels the subsampling.
+    `signature` (see file_signature) only keys the cache on file changes.
+    """
+    to_mercator = get_transformer("EPSG:3067", "EPSG:3857")
 
-    # DSM with all points
-    dsm, _, _ = np.histogram2d(
-        x_merc,
-        y_merc,
-        bins=resolution,
-        weights=z,
-        density=True
-    )
+    with laspy.open(lidar_path) as las:
+        # Grid extent from the header, so the histograms can be filled incrementally
+        header = las.header
+        minx, miny, maxx, maxy = to_mercator.transform_bounds(
+            header.mins[0], header.mins[1], header.maxs[0], header.maxs[1]
+        )
+        x_edges = np.linspace(minx, maxx, resolution + 1)
+        y_edges = np.linspace(miny, maxy, resolution + 1)
+
+        dsm_sum = np.zeros((resolution, resolution), dtype=np.float64)
+        dtm_sum = np.zeros((resolution, resolution), dtype=np.float64)
+
+        for points in las.chunk_iterator(chunk_size):
+            points = points[::stride]
+            x_merc, y_merc = to_mercator.transform(np.asarray(points.x), np.asarray(points.y))
+            z = np.asarray(points.z)
+
+            # DSM with all points
+            h, _, _ = np.histogram2d(x_merc, y_merc, bins=[x_edges, y_edges], weights=z)
+            dsm_sum += h
+
+            # Ground points => DTM
+            ground_mask = np.asarray(points.classification) == 2
+            if np.any(ground_mask):
+                h, _, _ = np.histogram2d(
+                    x_merc[ground_mask],
+                    y_merc[ground_mask],
+                    bins=[x_edges, y_edges],
+                    weights=z[ground_mask],
+                )
+                dtm_sum += h
+
+    dsm = weighted_density(dsm_sum, x_edges, y_edges)
+    dtm = weighted_density(dtm_sum, x_edges, y_edges)
 
     # CHM
     chm = np.clip(dsm - dtm, 0, None)
@@ -85,34 +116,67 @@ def compute_tile_path_length_km(x_edges, y_edges):
     diagonal_m = np.sqrt(dx_m**2 + dy_m**2)
     return diagonal_m / 1000.0  # meters -> km
 
+@st.cache_resource
+def get_itu_kernel():
+    """Parallel numba ufunc for a * chm**0.6 * path, compiled once; None without numba."""
+    if numba is None:
+        return None
+
+    # No nnan/ninf fast-math flags: empty cells carry NaN through to the overlay
+    @numba.vectorize(
+        ["float64(float64, float64, float64)", "float32(float32, float32, float32)"],
+        target="parallel",
+        fastmath={"afn", "arcp", "contract"},
+    )
+    def itu_kernel(chm, a, path):
+        return a * chm ** 0.6 * path
+
+    return itu_kernel
+
 def itu_r_p833(canopy_height, freq_ghz, path_length_km=1.0):
     """Simple ITU-based attenuation model (dB)."""
-    A0 = 0.2 * (freq_ghz ** 0.3) * (canopy_height ** 0.6)
-    return A0 * path_length_km  # in dB
+    a = 0.2 * (freq_ghz ** 0.3)
+    kernel = get_itu_kernel()
+    if kernel is None:
+        return a * (canopy_height ** 0.6) * path_length_km  # in dB
+    return kernel(canopy_height, a, path_length_km)  # in dB
 
-def create_colorized_overlay(att_map, x_edges, y_edges, vmin, vmax, cmap):
+@st.cache_data
+def create_colorized_overlay(att_map, x_edges, y_edges, vmin, vmax, cmap_name):
     """
-    Convert a 2D attenuation map into a colorized RGBA image.
-    Returns (PIL.Image, (lat_min, lat_max, lon_min, lon_max)).
+    Convert a 2D attenuation map into a colorized, paletted PNG.
+    Returns (content_hash, png_bytes, (lat_min, lat_max, lon_min, lon_max)).
     """
     norm = mcolors.Normalize(vmin=vmin, vmax=vmax)
-    colormapped = cmap(norm(att_map))  # shape => (nx, ny, 4)
+    cmap = plt.get_cmap(cmap_name)
 
-    # Fix orientation: transpose, then flip vertically
-    colormapped_t = colormapped.transpose((1, 0, 2))
-    colormapped_t = np.flipud(colormapped_t)
+    # Normalize once; transpose + vertical flip is a view, not a copy
+    normed = np.ma.getdata(norm(att_map)).T[::-1]
 
-    # Per-pixel alpha to make low attenuation more transparent
-    alpha_vals = norm(att_map).transpose()
-    alpha_vals = np.flipud(alpha_vals)
-    alpha_scaled = 0.1 + 0.9 * alpha_vals
-    colormapped_t[..., 3] = alpha_scaled
+    # 8-bit palette: 255 color levels plus a fully transparent index for NaN
+    levels = np.linspace(0.0, 1.0, 255)
+    palette = np.zeros((256, 3), dtype=np.uint8)
+    palette[:255] = cmap(levels, bytes=True)[:, :3]
 
-    colormapped_8bit = (colormapped_t * 255).astype(np.uint8)
-    img = Image.fromarray(colormapped_8bit, mode="RGBA")
+    # Per-level alpha to make low attenuation more transparent
+    alpha = np.zeros(256, dtype=np.uint8)
+    alpha[:255] = (25.5 + 229.5 * levels).astype(np.uint8)
+
+    idx = np.multiply(normed, 254)
+    np.rint(idx, out=idx)
+    np.clip(idx, 0, 254, out=idx)
+    idx[np.isnan(normed)] = 255
+    idx = idx.astype(np.uint8)
+    img = Image.fromarray(idx)
+    img.putpalette(palette.tobytes())
+
+    buffer = BytesIO()
+    img.save(buffer, format="PNG", transparency=alpha.tobytes())
+    png_bytes = buffer.getvalue()
+    content_hash = hashlib.blake2b(png_bytes, digest_size=8).hexdigest()
 
     # Convert bounding box from EPSG:3857 -> EPSG:4326
-    transformer_to_wgs84 = Transformer.from_crs("EPSG:3857", "EPSG:4326", always_xy=True)
+    transformer_to_wgs84 = get_transformer("EPSG:3857", "EPSG:4326")
     minx, maxx = x_edges[0], x_edges[-1]
     miny, maxy = y_edges[0], y_edges[-1]
     bottom_left = transformer_to_wgs84.transform(minx, miny)  # (lon, lat)
@@ -121,7 +185,7 @@ def create_colorized_overlay(att_map, x_edges, y_edges, vmin, vmax, cmap):
     lat_min, lon_min = bottom_left[1], bottom_left[0]
     lat_max, lon_max = top_right[1], top_right[0]
 
-    return img, (lat_min, lat_max, lon_min, lon_max)
+    return content_hash, png_bytes, (lat_min, lat_max, lon_min, lon_max)
 
 # --- Main Logic ---
 freq_ghz = st.sidebar.slider("Frequency (GHz)", 0.1, 10.0, 2.4, 0.1)
@@ -131,7 +195,7 @@ all_vals = []
 
 for fname in lidar_files:
     path = os.path.join(UPLOAD_DIR, fname)
-    chm, x_edges, y_edges = load_and_compute_chm(path)
+    chm, x_edges, y_edges = load_and_compute_chm(path, file_signature(path))
     path_length_km = compute_tile_path_length_km(x_edges, y_edges)
     att_map = itu_r_p833(chm, freq_ghz, path_length_km)
     maps_data.append((att_map, x_edges, y_edges))
@@ -155,25 +219,24 @@ cbar = fig.colorbar(sm, cax=ax, orientation="vertical")
 cbar.set_label("Attenuation [dB]", rotation=90)
 
 # Center the map on the first file
-sample_chm, sx_edges, sy_edges = load_and_compute_chm(os.path.join(UPLOAD_DIR, lidar_files[0]))
+sample_path = os.path.join(UPLOAD_DIR, lidar_files[0])
+sample_chm, sx_edges, sy_edges = load_and_compute_chm(sample_path, file_signature(sample_path))
 cx = (sx_edges[0] + sx_edges[-1]) / 2
 cy = (sy_edges[0] + sy_edges[-1]) / 2
-transform_merc2ll = Transformer.from_crs("EPSG:3857", "EPSG:4326", always_xy=True)
+transform_merc2ll = get_transformer("EPSG:3857", "EPSG:4326")
 center_lon, center_lat = transform_merc2ll.transform(cx, cy)
 m = folium.Map(location=[center_lat, center_lon], zoom_start=14)
 
 # Overlay each tile on the Folium map
 for (att_map, x_edges, y_edges) in maps_data:
-    img, (lat_min, lat_max, lon_min, lon_max) = create_colorized_overlay(
-        att_map, x_edges, y_edges, global_min, global_max, cmap
+    content_hash, png_bytes, (lat_min, lat_max, lon_min, lon_max) = create_colorized_overlay(
+        att_map, x_edges, y_edges, global_min, global_max, cmap.name
     )
-    buffer = BytesIO()
-    img.save(buffer, format="PNG")
-    data_uri = "data:image/png;base64," + b64encode(buffer.getvalue()).decode("utf-8")
+    image_url = publish_overlay(content_hash, png_bytes)
 
     bounds = [[lat_min, lon_min], [lat_max, lon_max]]
-    folium.raster_layers.ImageOverlay(
-        image=data_uri,
+    StaticImageOverlay(
+        image_url,
         bounds=bounds,
         opacity=1.0,    # rely on per-pixel alpha
         origin="upper",
@@ -0,0 +1,164 @@
+import importlib.util
+import os
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+laspy = pytest.importorskip("laspy")
+pytest.importorskip("pyproj")
+
+SCRIPT = Path(__file__).resolve().parents[1] / "scripts" / "preprocess_lidar.py"
+spec = importlib.util.spec_from_file_location("preprocess_lidar", SCRIPT)
+preprocess_lidar = importlib.util.module_from_spec(spec)
+sys.modules[spec.name] = preprocess_lidar  # pool tasks and numba's on-disk cache look it up by name
+spec.loader.exec_module(preprocess_lidar)
+if preprocess_lidar.numba is not None:
+    # TBB hangs at exit once this process forks the pool after running a kernel
+    preprocess_lidar.numba.config.THREADING_LAYER = "workqueue"
+
+# x, y, z and classification of a few points on a 4x4 grid over (0, 0)-(4, 4)
+GRID_POINTS = (
+    np.array([0.5, 0.5, 1.5, 3.9, 3.9]),
+    np.array([0.5, 0.5, 2.5, 3.9, 0.1]),
+    np.array([10.0, 20.0, 5.0, 7.0, 1.0]),
+    np.array([2, 1, 2, 1, 2], dtype=np.uint8),
+)
+
+
+def write_las(path, x, y, z=None, classification=None):
+    header = laspy.LasHeader(point_format=3, version="1.2")
+    header.scales = np.array([0.01, 0.01, 0.01])
+    header.offsets = np.array([0.0, 0.0, 0.0])
+    las = laspy.LasData(header)
+    las.x = x
+    las.y = y
+    las.z = np.zeros(len(x)) if z is None else z
+    if classification is not None:
+        las.classification = classification
+    las.write(path)
+    return path
+
+
+def grid_args(path, cache_path=None):
+    return (path, 0, 5, 4, 2, 0.0, 0.0, 1.0, 1.0, cache_path)
+
+
+@pytest.fixture
+def grid_las(tmp_path):
+    return write_las(tmp_path / "grid.las", *GRID_POINTS)
+
+
+@pytest.mark.parametrize("use_numba", [True, False])
+def test_grids_for_span_bins_points(grid_las, monkeypatch, use_numba):
+    if use_numba:
+        pytest.importorskip("numba")
+        monkeypatch.setattr(preprocess_lidar.numba, "get_num_threads", lambda: 3)
+    else:
+        monkeypatch.setattr(preprocess_lidar, "numba", None)
+
+    preprocess_lidar._init_worker("EPSG:3857", 1)
+    dsm_sum, dsm_cnt, dtm_sum, dtm_cnt = preprocess_lidar._grids_for_span(grid_args(grid_las))
+
+    assert dsm_cnt.sum() == 5 and dtm_cnt.sum() == 3
+    assert dsm_sum[0, 0] == pytest.approx(30.0) and dsm_cnt[0, 0] == 2
+    assert dtm_sum[0, 0] == pytest.approx(10.0) and dtm_cnt[0, 0] == 1
+    assert dsm_sum[1, 2] == pytest.approx(5.0) and dtm_sum[1, 2] == pytest.approx(5.0)
+    assert dsm_sum[3, 3] == pytest.approx(7.0) and dtm_cnt[3, 3] == 0
+    assert dtm_sum[3, 0] == pytest.approx(1.0)
+
+
+def test_compute_grids_parallel_sums_into_shared_memory(tmp_path):
+    # Split the points over two files so both workers add into the shared grids
+    paths = [
+        write_las(tmp_path / "a.las", *(column[:2] for column in GRID_POINTS)),
+        write_las(tmp_path / "b.las", *(column[2:] for column in GRID_POINTS)),
+    ]
+    bounds = (0.0, 0.0, 4.0, 4.0)
+    chm, dtm, valid = preprocess_lidar.compute_grids_parallel(paths, 4, 2, 2, "EPSG:3857", bounds, 2)
+
+    assert valid.sum() == 3 and valid[0, 0] and valid[1, 2] and valid[3, 0]
+    assert dtm[0, 0] == pytest.approx(10.0) and chm[0, 0] == pytest.approx(5.0)
+    assert dtm[1, 2] == pytest.approx(5.0) and chm[1, 2] == 0.0
+    assert dtm[3, 0] == pytest.approx(1.0) and chm[3, 0] == 0.0
+
+
+def chunk_xs(chunks):
+    return [np.asarray(points.x).tolist() for points in chunks]
+
+
+@pytest.fixture
+def las_path(tmp_path):
+    return write_las(tmp_path / "tile.las", np.arange(10.0), np.zeros(10))
+
+
+def test_iter_chunks_whole_file(las_path):
+    xs = chunk_xs(preprocess_lidar.iter_chunks(las_path, 4))
+    assert xs == [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]]
+
+
+def test_iter_chunks_span(las_path):
+    xs = chunk_xs(preprocess_lidar.iter_chunks(las_path, 4, start=3, stop=8))
+    assert xs == [[3, 4, 5, 6], [7]]
+
+
+@pytest.mark.parametrize("start, stop", [(0, None), (3, None), (3, 8)])
+def test_prefetch_matches_iter_chunks(las_path, start, stop):
+    expected = chunk_xs(preprocess_lidar.iter_chunks(las_path, 4, start, stop))
+    assert chunk_xs(preprocess_lidar.prefetch_chunks(las_path, 4, start, stop)) == expected
+
+
+def test_prefetch_propagates_errors(tmp_path):
+    with pytest.raises(Exception):
+        list(preprocess_lidar.prefetch_chunks(tmp_path / "missing.las", 4))
+
+
+def test_split_tasks_covers_every_point(tmp_path):
+    a = write_las(tmp_path / "a.las", np.arange(10.0), np.zeros(10))
+    b = write_las(tmp_path / "b.las", np.arange(3.0), np.zeros(3))
+    spans = preprocess_lidar.split_tasks([a, b], 4)
+    assert spans == [(a, 0, 4), (a, 4, 8), (a, 8, 10), (b, 0, 3)]
+
+    xs = []
+    for path, start, stop in spans:
+        for chunk in chunk_xs(preprocess_lidar.prefetch_chunks(path, 3, start, stop)):
+            xs.extend(chunk)
+    assert xs == list(range(10)) + list(range(3))
+
+
+def test_header_bounds_skip_empty_files(tmp_path):
+    a = write_las(tmp_path / "a.las", 1000.0 + np.arange(10.0), np.full(10, 2000.0))
+    empty = write_las(tmp_path / "empty.las", np.zeros(0), np.zeros(0))
+    bounds = preprocess_lidar.compute_header_bounds([a, empty], "EPSG:3857")
+    assert bounds == pytest.approx((1000.0, 2000.0, 1009.0, 2000.0))
+
+    with pytest.raises(RuntimeError, match="No valid bounds"):
+        preprocess_lidar.compute_header_bounds([empty], "EPSG:3857")
+
+
+def test_span_cache_hit_and_mtime_miss(grid_las, tmp_path, monkeypatch):
+    def cache_path():
+        return preprocess_lidar.span_cache_path(tmp_path, grid_las, 0, 5, 4, bounds, "EPSG:3857")
+
+    bounds = (0.0, 0.0, 4.0, 4.0)
+    path = cache_path()
+    assert path == cache_path() and not path.exists()
+
+    preprocess_lidar._init_worker("EPSG:3857", 1)
+    grids = preprocess_lidar._grids_for_span(grid_args(grid_las, path))
+    assert path.exists()
+
+    # A hit is served from the .npz without reading any points
+    def no_read(*args, **kwargs):
+        raise AssertionError("points read despite a cache hit")
+
+    monkeypatch.setattr(preprocess_lidar, "prefetch_chunks", no_read)
+    cached = preprocess_lidar._grids_for_span(grid_args(grid_las, path))
+    for grid, hit in zip(grids, cached):
+        np.testing.assert_array_equal(grid, hit)
+
+    # Rewriting the LAZ file changes its mtime, so the old entry is no longer used
+    stat = os.stat(grid_las)
+    os.utime(grid_las, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+    assert cache_path() != path
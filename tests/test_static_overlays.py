@@ -0,0 +1,43 @@
+import importlib.util
+import os
+from pathlib import Path
+
+import pytest
+
+folium = pytest.importorskip("folium")
+
+MODULE = Path(__file__).resolve().parents[1] / "static_overlays.py"
+spec = importlib.util.spec_from_file_location("static_overlays", MODULE)
+static_overlays = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(static_overlays)
+
+
+def test_overlay_renders_static_url():
+    url = f"{static_overlays.OVERLAY_URL}/0123456789abcdef.png"
+    m = folium.Map(location=[60.0, 25.0], zoom_start=14)
+    static_overlays.StaticImageOverlay(url, [[59.9, 24.9], [60.1, 25.1]], origin="upper").add_to(m)
+
+    html = m.get_root().render()
+    assert url in html
+    assert "data:" not in html
+
+
+def test_publish_overlay_writes_once(tmp_path):
+    url = static_overlays.publish_overlay("aa", b"png", overlay_dir=tmp_path)
+    assert url == f"{static_overlays.OVERLAY_URL}/aa.png"
+    assert (tmp_path / "aa.png").read_bytes() == b"png"
+
+    assert static_overlays.publish_overlay("aa", b"other", overlay_dir=tmp_path) == url
+    assert (tmp_path / "aa.png").read_bytes() == b"png"
+    assert [p.name for p in tmp_path.iterdir()] == ["aa.png"]
+
+
+def test_publish_overlay_prunes_least_recently_used(tmp_path):
+    for age, name in enumerate(["c", "b", "a"]):
+        static_overlays.publish_overlay(name, b"png", overlay_dir=tmp_path, keep=3)
+        os.utime(tmp_path / f"{name}.png", ns=(0, (10 - age) * 10**9))
+
+    # Reusing "a" makes it the most recent, so "b" is the one dropped
+    static_overlays.publish_overlay("a", b"png", overlay_dir=tmp_path, keep=3)
+    static_overlays.publish_overlay("d", b"png", overlay_dir=tmp_path, keep=3)
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["a.png", "c.png", "d.png"]